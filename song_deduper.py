@@ -8,19 +8,36 @@ import time
 import mutagen   # python3 -m pip install mutagen
 from mutagen import easyid3
 import acoustid  # python3 -m pip install pyacoustid
-import glob
+import numpy as np  # python3 -m pip install numpy
+from blake3 import blake3  # python3 -m pip install blake3
 import pickle
-import hashlib
+import mmap
+import subprocess
 from argparse import ArgumentParser
-from dataclasses import dataclass
-from collections.abc import Sequence
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from operator import attrgetter
+from collections.abc import Callable, Hashable, Sequence
 from collections import defaultdict
-from typing import Optional
+from typing import BinaryIO, Optional
 
 pickle_filename = 'music_datas.pickle'
+cache_version = 7  # Bump when MusicData changes
+max_bit_error = 2  # Fingerprint comparison settings, as in acoustid
+max_align_offset = 120
+fpcalc_batch_size = 64  # Most songs to fingerprint per fpcalc run
+supported_extensions = ('.mp3', '.m4a', '.MP3', '.M4A')
+# Directories that hold artwork, thumbnails or library files, but not songs
+skip_dirs = {'@eaDir', '__MACOSX', 'Album Artwork', 'Previous iTunes Libraries'}
 
 
-@dataclass(frozen=True)
+class StaleCacheError(Exception):
+    """The cache files can't be used: They were written by a different
+    version of this script, or the fingerprints file is missing or doesn't
+    go with the cache file."""
+
+
+@dataclass(frozen=True, slots=True)
 class MusicData:
     artist: str
     album: str
@@ -31,163 +48,335 @@ class MusicData:
     disc_total: int
     track_num: int
     track_total: int
-    fingerprint: tuple[float, Sequence[bytes]]
-    md5: str
+    duration: float
+    fingerprint: np.ndarray = field(compare=False)  # Chromaprint uint32s
+    content_hash: str
+    mtime_ns: int  # To tell if the file changed since it was cached
+    size: int
 
 
-def musicdata_from_easyid3(m, fingerprint, md5) -> MusicData:
-    try:
-        artist = m["artist"][0]
-    except KeyError:
-        artist = None
-    try:
-        album = m["album"][0]
-    except KeyError:
-        album = None
-    try:
-        title = m["title"][0]
-    except KeyError:
-        title = None
-    try:
-        year = m["date"][0].isdigit() and int(m["date"][0][:4]) or None
-    except KeyError:
-        year = None
-    try:
-        genre = m["genre"][0]
-    except KeyError:
-        genre = None
-    print(f'MP3 Artist:{artist} Album:{album} Title:{title}')
-    try:
-        if m["discnumber"][0].isdigit():
-            disc_num = int(m["discnumber"][0])
-            disc_total = None
-        elif '/' in m["discnumber"][0]:
-            disc_num, disc_total = [int(i) for i in m["discnumber"][0].split('/', 1)]
-        else:
-            disc_num = disc_total = None
-    except KeyError:
-        disc_num = disc_total = None
-    try:
-        if m["tracknumber"][0].isdigit():
-            track_num = int(m["tracknumber"][0])
-            track_total = None
-        elif '/' in m["tracknumber"][0]:
-            track_num, track_total = [int(i) for i in m["tracknumber"][0].split('/', 1)]
-        else:
-            track_num = track_total = None
-    except KeyError:
-        track_num = track_total = None
-    return MusicData(artist, album, title, genre, year, disc_num, disc_total,
-                     track_num, track_total, fingerprint, md5)
+def first_tag(tags, key: str):
+    """Return the first value for key in a mutagen tags dict, or None."""
+    return (tags.get(key) or [None])[0]
 
 
-def musicdata_from_m4a(m, fingerprint, md5) -> MusicData:
-    try:
-        artist = m.tags['\xa9ART'][0]
-    except KeyError:
-        artist = None
-    try:
-        album = m.tags['\xa9alb'][0]
-    except KeyError:
-        album = None
-    try:
-        title = m.tags['\xa9nam'][0]
-    except KeyError:
-        title = None
+def parse_year(date: Optional[str]) -> Optional[int]:
+    """Return the year from a "2001" style date, or None."""
+    return date and date.isdigit() and int(date[:4]) or None
+
+
+def parse_num_total(s: Optional[str]) -> tuple[Optional[int], Optional[int]]:
+    """Parse a "1" or "1/12" style disc or track number into (num, total)."""
+    if not s:
+        return None, None
+    num, _, total = s.partition('/')
     try:
-        genre = m.tags['\xa9gen'][0]
-    except KeyError:
-        genre = None
+        return int(num), total and int(total) or None
+    except ValueError:
+        return None, None
+
+
+def musicdata_from_easyid3(m, duration, fingerprint, content_hash, mtime_ns, size) -> MusicData:
+    artist = first_tag(m, "artist")
+    album = first_tag(m, "album")
+    title = first_tag(m, "title")
+    print(f'MP3 Artist:{artist} Album:{album} Title:{title}')
+    disc_num, disc_total = parse_num_total(first_tag(m, "discnumber"))
+    track_num, track_total = parse_num_total(first_tag(m, "tracknumber"))
+    return MusicData(artist, album, title, first_tag(m, "genre"),
+                     parse_year(first_tag(m, "date")), disc_num, disc_total,
+                     track_num, track_total, duration, fingerprint, content_hash,
+                     mtime_ns, size)
+
+
+def musicdata_from_m4a(m, duration, fingerprint, content_hash, mtime_ns, size) -> MusicData:
+    tags = m.tags or {}
+    artist = first_tag(tags, '\xa9ART')
+    album = first_tag(tags, '\xa9alb')
+    title = first_tag(tags, '\xa9nam')
     print(f'MP4 Artist:{artist} Album:{album} Title:{title}')
-    try:
-        year = m.tags['\xa9day'][0].isdigit() and int(m.tags['\xa9day'][0][:4]) or None
-    except KeyError:
-        year = None
-    try:
-        disc_num, disc_total = m.tags['disk'][0]
-    except KeyError:
-        disc_num = disc_total = None
-    try:
-        track_num, track_total = m.tags['trkn'][0]
-    except KeyError:
-        track_num = track_total = None
-    return MusicData(artist, album, title, genre, year, disc_num, disc_total,
-           track_num, track_total, fingerprint, md5)
+    disc_num, disc_total = first_tag(tags, 'disk') or (None, None)
+    track_num, track_total = first_tag(tags, 'trkn') or (None, None)
+    return MusicData(artist, album, title, first_tag(tags, '\xa9gen'),
+                     parse_year(first_tag(tags, '\xa9day')), disc_num, disc_total,
+                     track_num, track_total, duration, fingerprint, content_hash,
+                     mtime_ns, size)
 
 
-def md5(fname: str) -> str:
-    """Return an MD5 hash for the provided file"""
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        #for chunk in iter(lambda: f.read(8192), b""):  # for Python < 3.8
-        while chunk := f.read(8192):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def content_hash(f: BinaryIO) -> str:
+    """Return a BLAKE3 hash of the open file's contents"""
+    if os.fstat(f.fileno()).st_size == 0:  # Empty files can't be mapped
+        return blake3().hexdigest()
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return blake3(mm).hexdigest()
 
 
 def has_supported_file_extension(filename: str) -> bool:
-    return filename[-4:].lower() in ('.mp3', '.m4a')
+    return filename.endswith(supported_extensions)
+
+
+def scan_dir(path: str) -> tuple[list[str], list[str], Optional[int]]:
+    """Return the song files and the subdirectories directly in path, and
+    path's mtime_ns, or None if it couldn't be scanned.
+    Like glob, skip hidden entries and unreadable directories. Also skip
+    directories in skip_dirs, and don't follow symlinks to directories,
+    which could make the same songs show up as dupes of themselves."""
+    files = []
+    dirs = []
+    try:
+        # Get the mtime first, so that changes made during the scan are seen next time.
+        mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in skip_dirs:
+                        dirs.append(entry.path)
+                elif has_supported_file_extension(entry.name):
+                    files.append(entry.path)
+    except OSError as e:
+        print(f'Warn: Could not scan {path}: {e}', file=sys.stderr)
+        return [], [], None
+    return files, dirs, mtime_ns
+
+
+def find_songs(path: str) -> tuple[list[str], dict[str, int]]:
+    """Walk the tree at path in parallel, returning the song files and a
+    dict of directory:mtime_ns. Each directory found is scanned as its own task."""
+    files = []
+    dir_mtimes = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pending = {executor.submit(scan_dir, path): path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, subdirs, mtime_ns = future.result()
+                if mtime_ns is not None:
+                    dir_mtimes[pending[future]] = mtime_ns
+                del pending[future]
+                files.extend(dir_files)
+                pending.update((executor.submit(scan_dir, d), d) for d in subdirs)
+    return files, dir_mtimes
+
+
+def dirs_changed(dir_mtimes: dict[str, int]) -> bool:
+    """Return whether any of the directories changed or went away since they
+    were scanned. Adding or removing a song changes its directory's mtime."""
+    for d, mtime_ns in dir_mtimes.items():
+        try:
+            if os.stat(d).st_mtime_ns != mtime_ns:
+                return True
+        except OSError:
+            return True
+    return False
 
 
 def glob_cache(path: str, fname_prefix: str) -> Sequence[str]:
     """Try to read a pickle file of filenames.
-    If it doesn't exist, create one."""
-    files = []
+    If it doesn't exist, or a directory changed since it was made, make a new one."""
     fname = fname_prefix + 'glob_cache.pickle'
     try:
         with open(fname, 'rb') as f:
-            files = pickle.load(f)
+            data = pickle.load(f)
+        # Older glob caches are a plain list, without the directory mtimes.
+        if isinstance(data, tuple) and not dirs_changed(data[0]):
+            return data[1]
     except FileNotFoundError:
-        for f in glob.glob(path + '/**', recursive=True):
-            if has_supported_file_extension(f):
-                files.append(f)
-        files.sort()
-        with open(fname, 'wb') as f:
-            pickle.dump(files, f)
+        pass
+    files, dir_mtimes = find_songs(path)
+    files.sort()
+    with open(fname, 'wb') as f:
+        pickle.dump((dir_mtimes, files), f, protocol=pickle.HIGHEST_PROTOCOL)
     return files
 
 
-def add_song_to_musicdata(song_file:str, music_datas:Dict[str, MusicData]) -> None:
-    """Create a MusicData from the song_file, add it to the dict."""
-    md5_ = md5(song_file)
-    fingerprint = acoustid.fingerprint_file(song_file)
-    if song_file.lower().endswith('.mp3'):
-        f = mutagen.easyid3.EasyID3(song_file)
-        md = musicdata_from_easyid3(f, fingerprint, md5_)
-    elif song_file.lower().endswith('.m4a'):
-        f = mutagen.File(song_file)
-        md = musicdata_from_m4a(f, fingerprint, md5_)
-    music_datas[song_file] = md
+def run_fpcalc(song_files: Sequence[str]) -> Optional[list[tuple[float, np.ndarray]]]:
+    """Run fpcalc once on the songs, asking for raw uint32 fingerprints.
+    Return a (duration, fingerprint) for each song, in order, or None if
+    fpcalc failed or didn't print exactly one result per song."""
+    fpcalc = os.environ.get(acoustid.FPCALC_ENVVAR, acoustid.FPCALC_COMMAND)
+    command = [fpcalc, '-raw', '-length', str(acoustid.MAX_AUDIO_LENGTH), *song_files]
+    try:
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        raise acoustid.NoBackendError("fpcalc not found")
+    if proc.returncode:
+        return None
+
+    # Some versions of fpcalc print a FILE= line before each result, some don't.
+    names = []
+    results = []
+    duration = None
+    for line in proc.stdout.splitlines():
+        key, _, value = line.partition(b'=')
+        if key == b'FILE':
+            names.append(os.fsdecode(value))
+        elif key == b'DURATION':
+            duration = float(value)
+        elif key == b'FINGERPRINT':
+            if duration is None:
+                return None
+            raw = value and value.split(b',') or []
+            results.append((duration, np.array(raw, dtype=np.int64).astype(np.uint32)))
+            duration = None
+    if len(results) != len(song_files) or (names and names != list(song_files)):
+        return None
+    return results
+
+
+def batch_fingerprint(song_files: Sequence[str]) -> dict[str, tuple[float, np.ndarray]]:
+    """Fingerprint the songs with one fpcalc run, instead of one per song.
+    Return a dict of filename:(duration, fingerprint) for the songs that
+    fpcalc could fingerprint. The fingerprints are arrays of uint32s."""
+    results = run_fpcalc(song_files)
+    if results is not None:
+        return dict(zip(song_files, results))
+    # Something in the batch failed. Run fpcalc on each song to find out which.
+    fingerprints = {}
+    if len(song_files) > 1:
+        for song_file in song_files:
+            results = run_fpcalc([song_file])
+            if results is not None:
+                fingerprints[song_file] = results[0]
+    return fingerprints
+
+
+def process_batch(song_files: Sequence[str], file_stats: Sequence[tuple[int, int]]) -> list[tuple[str, MusicData]]:
+    """Create a MusicData for each song_file, given its (mtime_ns, size).
+    A top-level function so that it can be sent to worker processes."""
+    fingerprints = batch_fingerprint(song_files)
+    music_datas = []
+    for song_file, (mtime_ns, size) in zip(song_files, file_stats):
+        try:
+            duration, fingerprint = fingerprints[song_file]
+        except KeyError:
+            print(f'Warn: Could not fingerprint {song_file}', file=sys.stderr)
+            continue
+        # Hash and read the tags from one open file. fpcalc just read it,
+        # so it's in the page cache.
+        with open(song_file, 'rb') as f:
+            content_hash_ = content_hash(f)
+            if song_file.lower().endswith('.mp3'):
+                m = mutagen.easyid3.EasyID3(f)
+                musicdata_from_tags = musicdata_from_easyid3
+            elif song_file.lower().endswith('.m4a'):
+                m = mutagen.File(f)
+                musicdata_from_tags = musicdata_from_m4a
+        md = musicdata_from_tags(m, duration, fingerprint, content_hash_, mtime_ns, size)
+        music_datas.append((song_file, md))
+    return music_datas
+
+
+def fingerprints_filename(fname: str) -> str:
+    """Return the name of the file that holds the fingerprints for a cache file"""
+    return fname + '.npy'
+
+
+def load_music_datas(fname: str) -> dict[str, MusicData]:
+    """Read a dict of filename:MusicData from the cache file.
+    The fingerprints are views into a memory mapped array of all of them.
+    Raise StaleCacheError if the files can't be used together."""
+    with open(fname, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Unpickling straight from the page cache avoids copying the file into a buffer
+        data = pickle.loads(mm)
+    if not isinstance(data, tuple) or data[0] != cache_version:
+        raise StaleCacheError(f'{fname} was written by another version of song_deduper')
+    _, music_datas, offsets, token = data
+    fps_fname = fingerprints_filename(fname)
+    try:
+        fingerprints = np.load(fps_fname, mmap_mode='r')
+    except FileNotFoundError:
+        raise StaleCacheError(f'{fps_fname} is missing')
+    # The token at the end of the fingerprints says which save they're from.
+    if (len(fingerprints) != offsets[-1] + len(token) or
+            fingerprints[offsets[-1]:].tobytes() != token.tobytes()):
+        raise StaleCacheError(f"{fps_fname} doesn't go with {fname}")
+    for md, begin, end in zip(music_datas.values(), offsets, offsets[1:]):
+        # MusicData is frozen, but this one was just unpickled and isn't shared
+        # yet. Setting the field directly avoids constructing it a second time.
+        object.__setattr__(md, 'fingerprint', fingerprints[begin:end])
+    return music_datas
+
+
+def save_music_datas(fname: str, music_datas: dict[str, MusicData]) -> None:
+    """Write a dict of filename:MusicData to the cache file.
+    The fingerprints are concatenated into one array in their own .npy file,
+    and the cache file gets the offset of each song's fingerprint in it.
+    Both files get a random token, so that a crash between writing one and
+    the other can't leave the fingerprints paired with the wrong offsets.
+    Write to temporary files first, so that anything that has the old
+    cache files mapped keeps seeing the old files."""
+    lengths = [len(md.fingerprint) for md in music_datas.values()]
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    token = np.frombuffer(os.urandom(8), dtype=np.uint32)
+    fingerprints = np.concatenate([md.fingerprint for md in music_datas.values()] + [token])
+    stripped = {song_file: replace(md, fingerprint=None) for song_file, md in music_datas.items()}
+    fps_fname = fingerprints_filename(fname)
+    with open(fps_fname + '.tmp', 'wb') as f:
+        np.save(f, fingerprints)
+    with open(fname + '.tmp', 'wb') as f:
+        pickle.dump((cache_version, stripped, offsets, token), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fps_fname + '.tmp', fps_fname)
+    os.replace(fname + '.tmp', fname)
+
+
+def stat_files(files: Sequence[str]) -> dict[str, tuple[int, int]]:
+    """Return a dict of filename:(mtime_ns, size) for the files that exist."""
+    stats = {}
+    for fname in files:
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            continue
+        stats[fname] = (st.st_mtime_ns, st.st_size)
+    return stats
 
 
-def get_music_datas(path: str, fname_prefix: str) -> Dict[str, MusicData]:
-    """Try to read a pickle file of a dict filename:MusicData
-    If there's no pickle file, make a new one."""
+def get_music_datas(path: str, fname_prefix: str) -> dict[str, MusicData]:
+    """Read the pickle file of a dict filename:MusicData, if there is one.
+    Then bring it up to date with the files on disk: Add new and changed
+    songs, drop removed songs, and save it if anything changed."""
     fname = fname_prefix + pickle_filename
-    musicdata = {}
     try:
-        with open(fname, 'rb') as f:
-            musicdata = pickle.load(f)
-    except FileNotFoundError:
-        files = glob_cache(path, fname_prefix)
-        for song_file in files:
-            add_song_to_musicdata(song_file, musicdata)
-        with open(fname, 'wb') as f:
-            pickle.dump(musicdata, f)
+        musicdata = load_music_datas(fname)
+    except (FileNotFoundError, StaleCacheError):
+        musicdata = {}
+    stats = stat_files(glob_cache(path, fname_prefix))
+    removed = musicdata.keys() - stats.keys()
+    for song_file in removed:
+        del musicdata[song_file]
+    changed = [f for f, file_stat in stats.items()
+               if f not in musicdata or (musicdata[f].mtime_ns, musicdata[f].size) != file_stat]
+    if changed:
+        # Hashing and fingerprinting are CPU heavy, so spread songs across cores,
+        # in batches that are small enough to keep every core busy.
+        workers = os.cpu_count() or 1
+        batch_size = min(fpcalc_batch_size, -(-len(changed) // workers))
+        batches = [changed[i:i + batch_size] for i in range(0, len(changed), batch_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch_music_datas in executor.map(process_batch, batches,
+                                                  [[stats[f] for f in b] for b in batches]):
+                musicdata.update(batch_music_datas)
+    if changed or removed:
+        save_music_datas(fname, musicdata)
     return musicdata
 
 
-def delete_files(fname: str, music_datas: Dict[str, MusicData]) -> bool:
+def delete_files(fname: str, music_datas: dict[str, MusicData]) -> bool:
     """Given a filename of a file with a list of mp3s or m4as to delete,
     delete them and also remove them from the music_datas dict.
     Return whether an updated music_datas needs to be written to disk."""
     changed = False
     for line in open(fname):
         fname = line.strip()
-        if os.path.isfile(fname) and has_supported_file_extension(fname):
-            os.unlink(fname)
-        else:
+        if not has_supported_file_extension(fname):
             print(f'Warn: Did not try to delete {fname}', file=sys.stderr)
+        else:
+            try:
+                os.unlink(fname)
+            except OSError as e:  # Let unlink find out if it's not a file
+                print(f'Warn: Could not delete {fname}: {e}', file=sys.stderr)
 
         if fname in music_datas:
             del music_datas[fname]
@@ -197,48 +386,62 @@ def delete_files(fname: str, music_datas: Dict[str, MusicData]) -> bool:
     return changed
 
 
-def process_music_datas(music_datas: Dict[str, MusicData]) -> None:
-    hashes = defaultdict(list)
-    tags = defaultdict(list)
+def group_by(music_datas: dict[str, MusicData], key: Callable[[MusicData], Hashable]) -> dict[Hashable, list[str]]:
+    """Return a dict of key(MusicData):[filenames with that key]"""
+    groups = defaultdict(list)
     for fname, info in music_datas.items():
-        hashes[info.md5].append(fname)
-        tags[(info.artist, info.title)].append(fname)
+        groups[key(info)].append(fname)
+    return groups
+
+
+by_hash = attrgetter('content_hash')
+by_artist_and_title = attrgetter('artist', 'title')
+
 
-    print_dupes(hashes, music_datas)
-    print_dupes(tags, music_datas)
+def process_music_datas(music_datas: dict[str, MusicData]) -> None:
+    print_dupes(group_by(music_datas, by_hash), music_datas)
+    print_dupes(group_by(music_datas, by_artist_and_title), music_datas)
 
 
-def print_dupes(dupes_dict: Dict, music_datas: Dict[str, MusicData]) -> None:
+def fingerprint_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Return how similar two decoded fingerprints are, from 0 to 1.
+    This is acoustid's fingerprint matching with NumPy doing the inner loop:
+    At each alignment offset, count the items that differ by at most
+    max_bit_error bits. The best offset's count is the score."""
+    if not len(a) or not len(b):
+        return 0.0
+    topcount = 0
+    for offset in range(1 - max_align_offset, max_align_offset + 1):
+        # Pair up a[i] with b[i - offset]
+        a_begin = max(0, offset)
+        a_end = min(len(a), len(b) + offset)
+        if a_begin >= a_end:
+            continue
+        biterrors = np.bitwise_count(a[a_begin:a_end] ^ b[a_begin - offset:a_end - offset])
+        topcount = max(topcount, np.count_nonzero(biterrors <= max_bit_error))
+    return topcount / min(len(a), len(b))
+
+
+def print_dupes(dupes_dict: dict, music_datas: dict[str, MusicData]) -> None:
     for k, fnames in dupes_dict.items():
         if len(fnames) == 1:
             continue
         print(f"\nSame {k}:")
-        prev_fingerprints = []
-        for fname in fnames:
+        # Compare each song to the first one only, not to every earlier one.
+        canonical_fp = music_datas[fnames[0]].fingerprint
+        print(f"---- {fnames[0]}")
+        for fname in fnames[1:]:
             # TODO: Also compare other keys, like album, track number?
-            for fp in prev_fingerprints:
-                similarity = acoustid.compare_fingerprints(fp,
-                                 music_datas[fname].fingerprint[1])
-                print(f"{similarity:1.2f} ", end='')
-            print('---- ' * (len(fnames) - len(prev_fingerprints) - 1), end='')
-            print(fname)
-            prev_fingerprints.append(music_datas[fname].fingerprint[1])
+            similarity = fingerprint_similarity(canonical_fp,
+                             music_datas[fname].fingerprint)
+            print(f"{similarity:1.2f} {fname}")
 
 
-def find_missing_songs(op_music_datas: Dict[str, MusicData], music_datas: Dict[str, MusicData]) -> None:
+def find_missing_songs(op_music_datas: dict[str, MusicData], music_datas: dict[str, MusicData]) -> None:
     """See what songs are on the other platform but not on this one"""
-    tags = defaultdict(list)
-    tags_set = set()
-    for fname, info in music_datas.items():
-        tags[(info.artist, info.title)].append(fname)
-        tags_set.add((info.artist, info.title))
-    op_tags = defaultdict(list)
-    op_tags_set = set()
-    for fname, info in op_music_datas.items():
-        op_tags[(info.artist, info.title)].append(fname)
-        op_tags_set.add((info.artist, info.title))
-    diff = op_tags_set - tags_set
-    for i in diff:
+    tags = set(map(by_artist_and_title, music_datas.values()))
+    op_tags = group_by(op_music_datas, by_artist_and_title)
+    for i in op_tags.keys() - tags:
         print(f'Missing: {i}: {op_tags[i]}')
 
 
@@ -248,16 +451,19 @@ def main(path: str, files_to_delete: Optional[str], fname_prefix: str) -> None:
         if delete_files(files_to_delete, music_datas):
             fname = fname_prefix + pickle_filename
             os.rename(fname, fname + '.old')
-            with open(fname, 'wb') as f:
-                pickle.dump(music_datas, f)
+            os.rename(fingerprints_filename(fname), fingerprints_filename(fname + '.old'))
+            save_music_datas(fname, music_datas)
     process_music_datas(music_datas)
 
     # Optional, if you want to compare with a remote collection
     other_platform = platform.system() == 'Darwin' and 'pc_music_datas.pickle' or 'mac_music_datas.pickle'
-    with open(other_platform, 'rb') as f:
-        op_music_datas = pickle.load(f)
-        process_music_datas(op_music_datas)
-        find_missing_songs(op_music_datas, music_datas)
+    try:
+        op_music_datas = load_music_datas(other_platform)
+    except StaleCacheError as e:
+        print(f'Warn: {e}, not comparing', file=sys.stderr)
+        return
+    process_music_datas(op_music_datas)
+    find_missing_songs(op_music_datas, music_datas)
 
 
 if __name__ == '__main__':